@@ -1,11 +1,19 @@
 import streamlit as st
 import google.generativeai as genai
-from PIL import Image
+from google.api_core import exceptions as google_exceptions
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 import io
 import os
-import docx
-import fitz  # PyMuPDF for PDF processing
+import hashlib
+import asyncio
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from pdf_render import iter_rendered_pages
+# PIL, docx and fitz (PyMuPDF) are imported where they are used, so reruns
+# that never touch an image, PDF or DOCX don't pay for loading them.
 
 # FIX 1: The function needs to be called with parentheses ()
 load_dotenv()
@@ -23,8 +31,13 @@ except (FileNotFoundError, KeyError):
     # Fallback for local development
     api_key = os.getenv("GEMINI_API_KEY")
 
-if api_key:
+@st.cache_resource
+def configure_gemini(api_key):
+    """Configures the Gemini client once per process instead of on every rerun."""
     genai.configure(api_key=api_key)
+
+if api_key:
+    configure_gemini(api_key)
 else:
     # FIX 2: Updated the error message to be consistent with the code
     st.error("Google API Key not found. Please set it as a Streamlit secret or as a 'GEMINI_API_KEY' environment variable in your .env file.")
@@ -33,32 +46,256 @@ else:
 
 
 # --- Gemini API Call Function ---
+# FIX 3: Corrected the model name to a valid, powerful vision model
+MODEL_NAME = 'gemini-2.5-pro'
+
+# PDF pages are sent several to a request; larger batches risk the per-request image limit
+PAGES_PER_REQUEST = 8
+
+# Rate-limit and overload errors are transient, so back off and try again before giving up
+retry_transient_errors = retry(
+    wait=wait_exponential_jitter(initial=1, max=16),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type((google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable)),
+    reraise=True
+)
+
+@st.cache_resource
+def get_model():
+    """Builds the Gemini model once and reuses it across pages and reruns."""
+    return genai.GenerativeModel(MODEL_NAME)
+
+# Finished analyses are shared across reruns and sessions, keyed by image content.
+# st.cache_data can't memoize coroutines, so the async path uses this dict directly.
+ANALYSIS_CACHE_SIZE = 64
+
+@st.cache_resource
+def get_analysis_cache():
+    """
+    Returns the process-wide cache of finished analyses and the lock that guards it.
+    Every session thread shares it, so only touch it through the helpers below.
+    """
+    return OrderedDict(), threading.Lock()
+
+def get_cached_analysis(key):
+    """Returns the cached analysis for key, or None if there isn't one."""
+    cache, lock = get_analysis_cache()
+    with lock:
+        return cache.get(key)
+
+def store_analysis(key, result):
+    """Caches a finished analysis, evicting the oldest entries beyond ANALYSIS_CACHE_SIZE."""
+    cache, lock = get_analysis_cache()
+    with lock:
+        cache[key] = result
+        while len(cache) > ANALYSIS_CACHE_SIZE:
+            cache.popitem(last=False)
+
+def analysis_cache_key(images, prompt, image_format):
+    """Hashes the image bytes so repeated pages map to the same short cache key."""
+    image_hash = hashlib.blake2b(digest_size=16)
+    for image_bytes in images:
+        image_hash.update(image_bytes)
+    return (image_hash.hexdigest(), prompt, image_format)
+
+def stream_analysis(image_bytes, prompt, image_format):
+    """Sends the image and a prompt to the Gemini API and yields the response text as it is generated."""
+    response = start_stream(get_model(), [prompt, make_image_part(image_bytes, image_format)])
+    for chunk in response:
+        yield chunk.text
+
+@retry_transient_errors
+def start_stream(model, parts):
+    """Opens a streaming request; rejections such as 429s surface here, before any text."""
+    return model.generate_content(parts, stream=True)
+
+@retry_transient_errors
+async def generate_analysis_async(model, images, prompt, image_format):
+    """
+    Sends one or more images and a prompt to the Gemini API in a single request
+    and returns the response text. Raises on failure and never touches the UI.
+    """
+    parts = [prompt] + [make_image_part(image_bytes, image_format) for image_bytes in images]
+    # The SDK's async client is shared process-wide and tied to the first event loop that
+    # used it, which asyncio.run closes. The sync client has no such tie, so run it in a thread.
+    response = await asyncio.to_thread(model.generate_content, parts)
+    return response.text
+
+async def analyze_batches_async(batches, prompt, image_format, on_batch, on_result, limit=6):
+    """
+    Analyzes batches of PDF pages concurrently, one request per batch, with at most
+    `limit` requests in flight on worker threads. `batches` is an iterable of (first_page_number, images);
+    it is pulled on a background thread, so producing the next batch (e.g. rendering
+    its pages) overlaps with the requests already in flight.
+    Calls on_batch(batch) as soon as each batch is sent, then on_result(batch, result,
+    placeholder) for each batch in order as soon as that batch and the ones before it
+    are done; placeholder is whatever on_batch returned, and result is the response
+    text or the exception raised.
+    If producing a batch fails, the batches already sent are still reported and the
+    exception is returned; otherwise returns None.
+    """
+    model = get_model()
+    semaphore = asyncio.Semaphore(limit)
+    loop = asyncio.get_running_loop()
+    pending = asyncio.Queue()
+
+    async def analyze_with_limit(first_page, images):
+        batch_prompt = make_batch_prompt(prompt, first_page, len(images))
+        key = analysis_cache_key(images, batch_prompt, image_format)
+        cached = get_cached_analysis(key)
+        if cached is not None:
+            return cached
+        async with semaphore:
+            result = await generate_analysis_async(model, images, batch_prompt, image_format)
+        store_analysis(key, result)
+        return result
+
+    async def dispatch_batches():
+        # One producer thread, so the batch iterator is never advanced concurrently
+        batch_iterator = iter(batches)
+        try:
+            with ThreadPoolExecutor(max_workers=1) as producer:
+                while True:
+                    try:
+                        batch = await loop.run_in_executor(producer, next, batch_iterator, None)
+                    except Exception as e:
+                        # Let the batches already sent finish and be reported before surfacing this
+                        return e
+                    if batch is None:
+                        break
+                    placeholder = on_batch(batch)
+                    task = asyncio.ensure_future(analyze_with_limit(*batch))
+                    await pending.put((batch, task, placeholder))
+        finally:
+            # The producer thread has stopped by now, so close the iterator here rather than
+            # leaving it to GC; whatever it holds is released even if the run is interrupted
+            close = getattr(batch_iterator, "close", None)
+            if close is not None:
+                close()
+            await pending.put(None)
+
+    async def report_results():
+        while True:
+            item = await pending.get()
+            if item is None:
+                break
+            batch, task, placeholder = item
+            try:
+                result = await task
+            except Exception as e:
+                result = e
+            on_result(batch, result, placeholder)
+
+    dispatch_error, _ = await asyncio.gather(dispatch_batches(), report_results())
+    return dispatch_error
+
+def batch_pages(page_images, batch_size):
+    """
+    Groups an iterable of page images into (first_page_number, images) batches.
+    If the iterable fails partway through a batch, the pages before the failure
+    are still yielded as a short batch before the error is re-raised.
+    """
+    page_images = iter(page_images)
+    first_page = 1
+    try:
+        while True:
+            images = []
+            try:
+                for image_bytes in itertools.islice(page_images, batch_size):
+                    images.append(image_bytes)
+            except Exception:
+                if images:
+                    yield (first_page, images)
+                raise
+            if not images:
+                return
+            yield (first_page, images)
+            first_page += len(images)
+    finally:
+        # Closing this generator closes the page source too, rather than leaving it to GC
+        close = getattr(page_images, "close", None)
+        if close is not None:
+            close()
+
+def make_batch_prompt(prompt, first_page, page_count):
+    """Prefixes the prompt with instructions for handling several attached pages."""
+    if page_count == 1:
+        return prompt
+    last_page = first_page + page_count - 1
+    return (
+        f"The {page_count} attached images are pages {first_page} to {last_page} of one PDF, in order. "
+        f"For each page, produce a `## Page k` section (where k is that page's number in the PDF) "
+        f"containing the Transcript and Summary described below.\n"
+        + prompt
+    )
+
+def page_range_label(first_page, page_count):
+    """Returns "Page 3" or "Pages 3-10" for use in headings."""
+    if page_count == 1:
+        return f"Page {first_page}"
+    return f"Pages {first_page}-{first_page + page_count - 1}"
+
+def make_image_part(image_bytes, image_format):
+    """The content for multi-modal input is a list of parts; this builds the image part."""
+    return {
+        "mime_type": f"image/{image_format.lower()}",
+        "data": image_bytes
+    }
+
 def analyze_image(image_bytes, prompt, image_format):
     """
-    Sends the image and a prompt to the Gemini API and returns the response.
+    Streams the Gemini analysis of the image onto the page as it is generated
+    and returns the full response text. A previously analyzed image is shown
+    from the cache without calling the API.
     """
+    key = analysis_cache_key([image_bytes], prompt, image_format)
+    cached = get_cached_analysis(key)
+    if cached is not None:
+        st.markdown(cached)
+        return cached
+
     try:
-        # FIX 3: Corrected the model name to a valid, powerful vision model
-        model = genai.GenerativeModel('gemini-2.5-pro')
-        
-        # The content for multi-modal input is a list of parts.
-        image_part = {
-            "mime_type": f"image/{image_format.lower()}",
-            "data": image_bytes
-        }
-        
-        # Pass the prompt and image together in a list
-        response = model.generate_content([prompt, image_part])
-        return response.text
+        analysis_result = st.write_stream(stream_analysis(image_bytes, prompt, image_format))
+        store_analysis(key, analysis_result)
+        return analysis_result
     except Exception as e:
         st.error(f"An error occurred while calling the Gemini API: {e}")
         return None
 
+# --- Helper function to shrink images before upload ---
+def encode_for_vision(image, max_side):
+    """
+    Caps the long edge of a PIL image at max_side pixels and returns grayscale JPEG bytes.
+    Vision tokens scale with pixel count, so this keeps uploads small and fast; handwriting
+    doesn't need color, and boosting contrast helps faint ink.
+    """
+    from PIL import Image, ImageOps
+
+    # For JPEGs this lets libjpeg decode straight at 1/2, 1/4 or 1/8 scale (and in
+    # grayscale), which is far cheaper than decoding every pixel and shrinking after
+    image.draft("L", (max_side, max_side))
+    image = image.copy()
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    image = ImageOps.autocontrast(image.convert("L"), cutoff=2)
+    img_byte_arr = io.BytesIO()
+    image.save(img_byte_arr, format="JPEG", quality=85, optimize=False)
+    return img_byte_arr.getvalue()
+
 # --- Helper function to create DOCX file ---
+@st.cache_data(show_spinner=False, max_entries=ANALYSIS_CACHE_SIZE, ttl="1h")
 def create_docx_bytes(content):
-    """Creates a DOCX file in memory from a string and returns its bytes."""
+    """
+    Creates a DOCX file in memory from a string and returns its bytes.
+    Cached by content, so re-running an analysis with the same text skips the XML build.
+    """
+    import docx
+
     doc = docx.Document()
     doc.add_paragraph(content)
+    return docx_to_bytes(doc)
+
+def docx_to_bytes(doc):
+    """Saves a python-docx Document in memory and returns its bytes."""
     bio = io.BytesIO()
     doc.save(bio)
     bio.seek(0)
@@ -73,6 +310,12 @@ st.markdown("Upload a handwritten note (image or PDF), and let Gemini AI transcr
 # 1. File Uploader - Now accepts PDF
 uploaded_file = st.file_uploader("1. Upload Your Document", type=["jpg", "jpeg", "png", "pdf"])
 
+# Longest image edge (in pixels) sent to Gemini for each detail level
+DETAIL_LEVELS = {"Low": 1024, "High": 2048}
+detail_level = st.selectbox("2. Detail Level", list(DETAIL_LEVELS), index=1,
+                            help="Higher detail reads small handwriting better but is slower and uses more tokens.")
+max_side = DETAIL_LEVELS[detail_level]
+
 # Define the prompt outside the logic branches so it's reusable
 prompt = """
 Based on the provided image of a handwritten document, perform the following two tasks:
@@ -95,26 +338,30 @@ if uploaded_file is not None:
 
     # --- IMAGE FILE LOGIC ---
     if file_type in ["image/jpeg", "image/png"]:
-        image = Image.open(uploaded_file)
-        st.image(image, caption="Uploaded Document", width=300) 
-
-        img_byte_arr = io.BytesIO()
-        image_format = image.format
-        image.save(img_byte_arr, format=image_format)
-        image_bytes = img_byte_arr.getvalue()
+        # st.image takes the upload directly, so showing the preview needs no decode here
+        st.image(uploaded_file, caption="Uploaded Document", width=300)
 
         if st.button("Analyze Document", use_container_width=True, type="primary"):
             with st.spinner("Gemini is analyzing your document, please wait..."):
+                from PIL import Image
+
+                # Image.open only reads the header here; pixels are decoded only if we need to downscale
+                image = Image.open(uploaded_file)
+                if max(image.size) > max_side:
+                    image_format = "JPEG"
+                    image_bytes = encode_for_vision(image, max_side)
+                else:
+                    # Send the uploaded bytes as-is rather than decoding and re-encoding them
+                    image_format = "JPEG" if file_type == "image/jpeg" else "PNG"
+                    image_bytes = uploaded_file.getvalue()
+
+                st.markdown("## Analysis Results")
                 analysis_result = analyze_image(image_bytes, prompt, image_format)
 
                 if analysis_result:
-                    st.markdown("## Analysis Results")
-                    st.markdown(analysis_result)
-
-                    docx_bytes = create_docx_bytes(analysis_result)
                     st.download_button(
                         label="Download Analysis as DOCX",
-                        data=docx_bytes,
+                        data=create_docx_bytes(analysis_result),
                         file_name="analysis_result.docx",
                         mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
                         use_container_width=True
@@ -124,44 +371,67 @@ if uploaded_file is not None:
 
     # --- PDF FILE LOGIC ---
     elif file_type == "application/pdf":
+        import fitz  # PyMuPDF for PDF processing
+
         pdf_bytes = uploaded_file.getvalue()
         doc = fitz.open(stream=pdf_bytes, filetype="pdf")
         
         st.info(f"PDF uploaded with {len(doc)} pages. Click 'Analyze' to process all pages.")
 
         if st.button("Analyze Full PDF", use_container_width=True, type="primary"):
-            all_results = []
+            import docx
+
+            # Results are written into the report as they arrive instead of being joined at the end
+            report = docx.Document()
             with st.spinner(f"Analyzing {len(doc)} pages... This may take a moment."):
-                for i, page in enumerate(doc):
-                    st.markdown(f"--- \n ### Analyzing Page {i + 1}")
-                    
-                    # Render page to an image
-                    pix = page.get_pixmap(dpi=200) # Higher DPI for better quality
-                    image = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                    
-                    st.image(image, caption=f"Page {i + 1}", width=300)
-                    
-                    # Convert PIL image to bytes for the API
-                    img_byte_arr = io.BytesIO()
-                    image.save(img_byte_arr, format="PNG")
-                    image_bytes = img_byte_arr.getvalue()
-
-                    # Call the API for the current page
-                    analysis_result = analyze_image(image_bytes, prompt, "PNG")
-                    
-                    if analysis_result:
-                        st.markdown(analysis_result)
-                        page_result_for_doc = f"## Results for Page {i + 1}\n\n{analysis_result}"
-                        all_results.append(page_result_for_doc)
-                    else:
-                        st.error(f"Failed to get a response for Page {i + 1}.")
-                        all_results.append(f"## Results for Page {i + 1}\n\n[ANALYSIS FAILED]")
+                def show_batch_pages(batch):
+                    # Show the previews while Gemini works; the results land in this
+                    # container too, so they stay under their own pages
+                    first_page, images = batch
+                    container = st.container()
+                    with container:
+                        st.markdown(f"--- \n ### Analyzing {page_range_label(first_page, len(images))}")
+                        for page_number, image_bytes in enumerate(images, start=first_page):
+                            st.image(image_bytes, caption=f"Page {page_number}", width=300)
+                    return container
+
+                def show_batch_result(batch, analysis_result, container):
+                    first_page, images = batch
+                    label = page_range_label(first_page, len(images))
+                    report.add_heading(f"Results for {label}", level=2)
+
+                    with container:
+                        st.markdown(f"### Results for {label}")
+
+                        if isinstance(analysis_result, Exception):
+                            st.error(f"An error occurred while calling the Gemini API for {label}: {analysis_result}")
+                            analysis_result = None
+
+                        if analysis_result:
+                            st.markdown(analysis_result)
+                            report.add_paragraph(analysis_result)
+                        else:
+                            st.error(f"Failed to get a response for {label}.")
+                            report.add_paragraph("[ANALYSIS FAILED]")
+
+                # Pack pages into multi-image requests to amortize round trips and the shared
+                # prompt. The requests are network-bound, so send batches on a single event
+                # loop, run here in the script thread so results can go straight to the UI.
+                # Each batch is sent as soon as its pages are rendered, so later pages render
+                # while Gemini works on earlier ones.
+                batches = batch_pages(iter_rendered_pages(pdf_bytes, max_side), PAGES_PER_REQUEST)
+                render_error = asyncio.run(analyze_batches_async(
+                    batches, prompt, "JPEG", show_batch_pages, show_batch_result
+                ))
+                if render_error:
+                    st.error(f"Failed to render the rest of the PDF: {render_error}")
+                    report.add_paragraph(f"[RENDERING FAILED: {render_error}]")
             
-            if all_results:
-                st.markdown("--- \n ## ✅ All Pages Processed")
-                final_analysis = "\n\n".join(all_results)
+            if len(doc):
+                if not render_error:
+                    st.markdown("--- \n ## ✅ All Pages Processed")
                 
-                docx_bytes = create_docx_bytes(final_analysis)
+                docx_bytes = docx_to_bytes(report)
                 st.download_button(
                     label="Download Full Analysis as DOCX",
                     data=docx_bytes,
@@ -169,4 +439,3 @@ if uploaded_file is not None:
                     mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
                     use_container_width=True
                 )
-
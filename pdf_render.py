@@ -0,0 +1,109 @@
+import os
+import queue
+import threading
+import multiprocessing
+
+# Rasterizing is CPU-bound and a fitz.Document can't be shared between threads, so larger
+# PDFs are rendered in worker processes, each with its own handle on the document.
+# These functions live outside handwritten.py because Streamlit runs that script as
+# __main__, which worker processes can't import.
+
+# Below this many pages, starting worker processes costs more than it saves
+MIN_PAGES_FOR_POOL = 3
+
+# The Streamlit server is multi-threaded and holds live gRPC channels, neither of which
+# survives a plain fork, so workers come from a clean forkserver (or spawn on Windows).
+if "forkserver" in multiprocessing.get_all_start_methods():
+    POOL_CONTEXT = multiprocessing.get_context("forkserver")
+else:
+    POOL_CONTEXT = multiprocessing.get_context("spawn")
+
+# Only one render pool runs at a time across all sessions, so concurrent uploads
+# queue up instead of each starting a process per CPU core
+POOL_SLOTS = threading.BoundedSemaphore(1)
+
+# Each worker process opens the PDF once and keeps it here
+worker_doc = None
+worker_max_side = None
+
+
+# --- Helper function to render PDF pages ---
+def render_page(page, max_side):
+    """
+    Renders a PDF page in grayscale at 200 DPI (capped so the long edge is at most
+    max_side) and returns JPEG bytes encoded by MuPDF, without a round trip through PIL.
+    """
+    import fitz
+
+    zoom = min(200 / 72, max_side / max(page.rect.width, page.rect.height))
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY)
+    image_bytes = pix.tobytes("jpeg", jpg_quality=85)
+    pix = None  # Free the pixmap's C-side buffer right away
+    return image_bytes
+
+
+def init_worker(pdf_bytes, max_side):
+    """Opens the PDF once per worker process so tasks only need to send a page number."""
+    import fitz
+
+    global worker_doc, worker_max_side
+    worker_doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    worker_max_side = max_side
+
+
+def render_page_number(page_number):
+    """Renders one page of the worker's PDF (page_number is zero-based)."""
+    return render_page(worker_doc[page_number], worker_max_side)
+
+
+# --- Render every page of a PDF ---
+def iter_rendered_pages(pdf_bytes, max_side):
+    """
+    Renders every page of the PDF to JPEG bytes and yields them in page order as
+    each one is ready, using one process per CPU core for longer documents.
+    """
+    import fitz
+
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        page_count = len(doc)
+        workers = min(os.cpu_count() or 1, page_count)
+        if page_count < MIN_PAGES_FOR_POOL or workers < 2:
+            for page in doc:
+                yield render_page(page, max_side)
+            return
+
+    # The pool runs on its own thread, so the shared slot and the worker processes are
+    # released as soon as rendering ends, even if this generator is abandoned mid-way
+    rendered = queue.Queue()
+    threading.Thread(
+        target=render_with_pool,
+        args=(rendered, pdf_bytes, page_count, workers, max_side),
+        daemon=True
+    ).start()
+    while True:
+        item = rendered.get()
+        if item is RENDER_DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+# Marks the end of the pages render_with_pool puts on its queue
+RENDER_DONE = object()
+
+
+def render_with_pool(rendered, pdf_bytes, page_count, workers, max_side):
+    """
+    Renders every page in a worker pool, putting each page's JPEG bytes on the
+    `rendered` queue in order, then the exception if one was raised, then RENDER_DONE.
+    """
+    try:
+        with POOL_SLOTS:
+            with POOL_CONTEXT.Pool(workers, initializer=init_worker, initargs=(pdf_bytes, max_side)) as pool:
+                for image_bytes in pool.imap(render_page_number, range(page_count)):
+                    rendered.put(image_bytes)
+    except Exception as e:
+        rendered.put(e)
+    finally:
+        rendered.put(RENDER_DONE)